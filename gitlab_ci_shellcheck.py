@@ -1,13 +1,18 @@
 import argparse
+import concurrent.futures
+import functools
 import json
 import os
 import pathlib
 import shutil
 import subprocess
+import sys
 import tempfile
 from typing import Any
 from typing import Dict
+from typing import FrozenSet
 from typing import Generic
+from typing import IO
 from typing import List
 from typing import Literal
 from typing import NoReturn
@@ -20,40 +25,63 @@ from typing import Union
 
 import yaml
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+# prefer the libyaml-backed implementations when pyyaml was built with them
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 class ReferenceTag(yaml.YAMLObject):
     yaml_tag = u'!reference'
 
     def __init__(self, value: Sequence[str]):
-        self.value = value
+        self.value: Tuple[str, ...] = tuple(value)
+        self._hash = hash(self.value)
 
     def __repr__(self) -> str:
         return f'ReferenceTag({self.value!r})'
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # string hashes are randomized per process, so the cached hash is not part of the state
+        return {'value': self.value}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.value = tuple(state['value'])
+        self._hash = hash(self.value)
+
     @classmethod
     def from_yaml(
-        cls, loader: Union[yaml.Loader, yaml.FullLoader, yaml.UnsafeLoader], node: yaml.Node
+        cls,
+        # quoted: the C-backed classes are missing when pyyaml is built without libyaml
+        loader: 'Union[yaml.SafeLoader, yaml.CSafeLoader, yaml.Loader, yaml.FullLoader, yaml.UnsafeLoader]',
+        node: yaml.Node,
     ) -> 'ReferenceTag':
         value = loader.construct_sequence(node)  # type: ignore[no-untyped-call]
         return cls(value)
 
     @classmethod
-    def to_yaml(cls, dumper: yaml.Dumper, data: 'ReferenceTag') -> yaml.nodes.SequenceNode:
+    def to_yaml(
+        cls, dumper: 'Union[yaml.SafeDumper, yaml.CSafeDumper, yaml.Dumper]', data: 'ReferenceTag'
+    ) -> yaml.nodes.SequenceNode:
         representation: yaml.nodes.SequenceNode
         representation = dumper.represent_sequence(cls.yaml_tag, data.value, flow_style=True)
         return representation
 
     def __hash__(self) -> int:
-        return hash(tuple(self.value))
+        return self._hash
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, ReferenceTag):
             return False
-        return hash(self) == hash(other)
+        return self._hash == other._hash and self.value == other.value
 
 
-yaml.add_constructor('!reference', ReferenceTag.from_yaml)
-yaml.add_multi_representer(ReferenceTag, ReferenceTag.to_yaml)
+Loader.add_constructor('!reference', ReferenceTag.from_yaml)
+Dumper.add_multi_representer(ReferenceTag, ReferenceTag.to_yaml)
 
 
 class ConfigDefaultsType(TypedDict):
@@ -95,12 +123,40 @@ class CiConfig(TypedDict, total=False):
     cache: Any
 
 
+class ShellcheckComment(TypedDict):
+    # a single diagnostic from shellcheck's json output format
+    file: str
+    line: int
+    endLine: int
+    column: int
+    endColumn: int
+    level: str
+    code: int
+    message: str
+    fix: Optional[Dict[str, Any]]
+
+
 class JobResult(TypedDict):
-    script_result: subprocess.CompletedProcess[str]
-    after_script_result: Optional[subprocess.CompletedProcess[str]]
+    script_diagnostics: List[ShellcheckComment]
+    after_script_diagnostics: Optional[List[ShellcheckComment]]
     result: Literal['pass', 'fail']
 
 
+_GLOBAL_KEYWORDS: FrozenSet[str] = frozenset(
+    {
+        'defaults',
+        'variables',
+        'workflow',
+        'image',
+        'stages',
+        'before_script',
+        'after_script',
+        'services',
+        'cache',
+    }
+)
+
+
 class ShellcheckNotFound(EnvironmentError):
     ...
 
@@ -109,40 +165,128 @@ class GitNotFound(EnvironmentError):
     ...
 
 
-def load_yaml(filepath: Union[str, pathlib.Path]) -> CiConfig:
+def _load_jobs_only(stream: IO[str]) -> Any:
+    """
+    Like yaml.load, but skips constructing the values of top-level global keywords.
+
+    The whole document is still composed into nodes, so anchors defined under global keys
+    remain available to aliases used by jobs.
+    """
+    loader = Loader(stream)
+    try:
+        node = loader.get_single_node()
+        if node is None:
+            return None
+        if isinstance(node, yaml.MappingNode):
+            # resolve top-level merge keys before filtering
+            loader.flatten_mapping(node)
+            node.value = [
+                (key, value)
+                for key, value in node.value
+                if not (isinstance(key, yaml.ScalarNode) and key.value in _GLOBAL_KEYWORDS)
+            ]
+        return loader.construct_document(node)
+    finally:
+        loader.dispose()
+
+
+def load_yaml(filepath: Union[str, pathlib.Path], jobs_only: bool = False) -> CiConfig:
+    """
+    :param filepath: filepath of the gitlab CI YAML configuration
+    :param jobs_only: omit global keywords (variables, stages, etc.) from the result, skipping their construction
+    :return: the parsed configuration
+    """
     with open(filepath) as f:
         y: CiConfig
-        y = yaml.load(f, Loader=yaml.Loader)
+        if jobs_only:
+            y = _load_jobs_only(f)
+        else:
+            y = yaml.load(f, Loader=Loader)
     if not isinstance(y, dict):
         raise ValueError(f'Unexpected CI configuration format. Was expecting a mapping, got {type(y)!r}')
     return y
 
 
-def shellcheck_string(script_text: str, shellcheck_args: Sequence[str]) -> subprocess.CompletedProcess[str]:
-    with tempfile.NamedTemporaryFile(mode='w+') as f:
-        f.write(script_text)
-        f.seek(0)
-        cp = subprocess.run(['shellcheck', *shellcheck_args, '-'], input=script_text, capture_output=True, text=True)
+def shellcheck_string(
+    script_text: str, shellcheck_args: Sequence[str], shellcheck_bin: str = 'shellcheck'
+) -> subprocess.CompletedProcess[str]:
+    cp = subprocess.run([shellcheck_bin, *shellcheck_args, '-'], input=script_text, capture_output=True, text=True)
     return cp
 
 
+def _shellcheck_chunk(
+    paths: Sequence[str], shellcheck_args: Sequence[str], shellcheck_bin: str
+) -> List[ShellcheckComment]:
+    cp = subprocess.run([shellcheck_bin, *shellcheck_args, *paths], capture_output=True, text=True)
+    # 0 means no issues, 1 means issues were found; anything else means shellcheck itself failed
+    if cp.returncode not in (0, 1):
+        raise subprocess.CalledProcessError(cp.returncode, cp.args, output=cp.stdout, stderr=cp.stderr)
+    comments: List[ShellcheckComment]
+    if cp.returncode == 0:
+        comments = []
+    elif orjson is not None:
+        comments = orjson.loads(cp.stdout)
+    else:
+        comments = json.loads(cp.stdout)
+    return comments
+
+
+def shellcheck_files(
+    paths: Sequence[str],
+    shellcheck_args: Sequence[str],
+    shellcheck_bin: str = 'shellcheck',
+    max_workers: Optional[int] = None,
+) -> Dict[str, List[ShellcheckComment]]:
+    """
+    Runs shellcheck against all the given files. shellcheck_args must select the json output format.
+
+    The files are split into at most max_workers chunks, each checked by a single shellcheck process,
+    and the processes are run concurrently.
+
+    :param paths: filepaths of the scripts to check
+    :param shellcheck_args: arguments passed to shellcheck ahead of the filepaths
+    :param shellcheck_bin: the shellcheck executable to run
+    :param max_workers: maximum number of concurrent shellcheck processes. Defaults to the number of CPUs
+    :return: mapping of each filepath to the diagnostics reported for it
+    """
+    diagnostics: Dict[str, List[ShellcheckComment]]
+    diagnostics = {path: [] for path in paths}
+    if not paths:
+        return diagnostics
+    num_chunks = min(len(paths), max_workers or os.cpu_count() or 1)
+    chunks = [paths[i::num_chunks] for i in range(num_chunks)]
+    check_chunk = functools.partial(_shellcheck_chunk, shellcheck_args=shellcheck_args, shellcheck_bin=shellcheck_bin)
+    # the work happens in shellcheck subprocesses, so threads are sufficient here
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_chunks) as executor:
+        for comments in executor.map(check_chunk, chunks):
+            for comment in comments:
+                diagnostics[comment['file']].append(comment)
+    return diagnostics
+
+
+def find_shellcheckrc(start: Union[str, pathlib.Path]) -> Optional[pathlib.Path]:
+    """
+    Finds the project rc file shellcheck would use for a script in the given directory,
+    checking for .shellcheckrc or shellcheckrc in that directory and each of its parents.
+
+    :param start: directory to start searching from
+    :return: the rc filepath, or None if there isn't one
+    """
+    directory = pathlib.Path(start).resolve()
+    for candidate_dir in (directory, *directory.parents):
+        for name in ('.shellcheckrc', 'shellcheckrc'):
+            rcfile = candidate_dir / name
+            if rcfile.is_file():
+                return rcfile
+    return None
+
+
 def yaml_to_jobs(ci_configuration: CiConfig) -> Sequence[Union[JobConfig, Dict[Any, Any]]]:  # TODO cleanup typehint
     # global_configs = {}  # TODO collect global configs to apply to job configs
-    global_keywords = [
-        'defaults',
-        'variables',
-        'workflow',
-        'image',
-        'stages',
-        'before_script',
-        'after_script',
-        'services',
-        'cache',
-    ]
     jobs: List[Union[JobConfig, Dict[Any, Any]]]
     jobs = []
     for key, value in ci_configuration.items():
-        if key not in global_keywords and isinstance(value, dict):
+        if key not in _GLOBAL_KEYWORDS and isinstance(value, dict):
             jobs.append(value)
     return jobs
 
@@ -206,29 +350,31 @@ def job_config_to_shell(job_config: Union[JobConfig, Dict[Any, Any]], shell: str
     return effective_script, after_script
 
 
+@functools.cache
 def _verify_shellcheck_available() -> Optional[str]:
     return shutil.which('shellcheck')
 
 
+@functools.cache
 def _verify_git_available() -> Optional[str]:
     return shutil.which('git')
 
 
 def _print_job_error(job_result: JobResult) -> None:
 
-    if job_result['script_result'].returncode != 0:
-        info = json.loads(job_result['script_result'].stdout)
-        print('Script validation error:\n', '\n'.join(r.get('message') for r in info))
+    if job_result['script_diagnostics']:
+        info = job_result['script_diagnostics']
+        print('Script validation error:\n', '\n'.join([r['message'] for r in info]))
 
-    if job_result['after_script_result'] and job_result['after_script_result'].returncode != 0:
-        info = json.loads(job_result['after_script_result'].stdout)
-        print('after_script: validation error:\n', '\n'.join(r.get('message') for r in info))
+    if job_result['after_script_diagnostics']:
+        info = job_result['after_script_diagnostics']
+        print('after_script: validation error:\n', '\n'.join([r['message'] for r in info]))
 
     return None
 
 
-def _main(filepath: str, no_fix: bool = False) -> int:
-    config = load_yaml(filepath)
+def _main(filepath: str, no_fix: bool = False, shellcheck_bin: str = 'shellcheck') -> int:
+    config = load_yaml(filepath, jobs_only=True)
     jobs = yaml_to_jobs(ci_configuration=config)
     job_results = []
     overall_status: Literal[0, 1]
@@ -237,37 +383,61 @@ def _main(filepath: str, no_fix: bool = False) -> int:
     if num_jobs < 1:
         print('No jobs to check')
         return 1
-    print(f'Collected {len(jobs)} jobs to check...')
-    for job in jobs:
-        script, after_script = job_config_to_shell(job_config=job)
-        # TODO: allow users to provide args
-        script_result = shellcheck_string(script_text=script, shellcheck_args=['-f', 'json', '-s', 'bash'])
-        if after_script.strip():
-            after_script_result = shellcheck_string(
-                script_text=after_script, shellcheck_args=['-f', 'json', '-s', 'bash']
-            )
-        else:
-            after_script_result = None
+    print(f'Collected {num_jobs} jobs to check...')
+    # TODO: allow users to provide args
+    shellcheck_args = ['-f', 'json', '-s', 'bash']
+    # scripts are checked from a temporary directory, so point shellcheck at the rc file
+    # it would have found when checking from the current directory
+    rcfile = find_shellcheckrc(os.getcwd())
+    if rcfile is not None:
+        shellcheck_args.extend(['--rcfile', os.fspath(rcfile)])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        script_paths: List[str]
+        script_paths = []
+        after_script_paths: List[Optional[str]]
+        after_script_paths = []
+        for job_index, job in enumerate(jobs):
+            script, after_script = job_config_to_shell(job_config=job)
+            script_path = os.path.join(tmpdir, f'job{job_index}_script.sh')
+            with open(script_path, 'w') as f:
+                f.write(script)
+            script_paths.append(script_path)
+            if after_script and not after_script.isspace():
+                after_script_path = os.path.join(tmpdir, f'job{job_index}_after.sh')
+                with open(after_script_path, 'w') as f:
+                    f.write(after_script)
+                after_script_paths.append(after_script_path)
+            else:
+                after_script_paths.append(None)
+        all_paths = [*script_paths, *(path for path in after_script_paths if path is not None)]
+        try:
+            diagnostics = shellcheck_files(all_paths, shellcheck_args=shellcheck_args, shellcheck_bin=shellcheck_bin)
+        except subprocess.CalledProcessError as e:
+            print(f'shellcheck failed with exit status {e.returncode}:\n{e.stderr}')
+            return 1
+
+    progress: List[str]
+    progress = []
+    for script_file, after_script_file in zip(script_paths, after_script_paths):
+        script_diagnostics = diagnostics[script_file]
+        after_script_diagnostics = diagnostics[after_script_file] if after_script_file is not None else None
 
         overall_result: Literal['pass', 'fail']
         overall_result = 'pass'
-        if script_result.returncode != 0:
+        if script_diagnostics:
             overall_result = 'fail'
-        if after_script_result and after_script_result.returncode != 0:
+        if after_script_diagnostics:
             overall_result = 'fail'
 
         job_result: JobResult
         job_result = {
-            'script_result': script_result,
-            'after_script_result': after_script_result,
+            'script_diagnostics': script_diagnostics,
+            'after_script_diagnostics': after_script_diagnostics,
             'result': overall_result,
         }
-        if job_result['result'] == 'pass':
-            print('.', end='')
-        else:
-            print('F', end='')
+        progress.append('.' if job_result['result'] == 'pass' else 'F')
         job_results.append(job_result)
-    print()
+    sys.stdout.write(''.join(progress) + '\n')
     for res in job_results:
         if res['result'] != 'pass':
             overall_status = 1
@@ -284,7 +454,9 @@ def main() -> int:
         '--no-fix', action='store_true', dest='no_fix', help='Reserved for future use. Has no effect currently'
     )
     args = parser.parse_args()
-    if not _verify_shellcheck_available():
+    # resolve shellcheck once so subprocesses don't need to search PATH again
+    shellcheck_bin = _verify_shellcheck_available()
+    if not shellcheck_bin:
         raise ShellcheckNotFound('Could not find shellcheck. Shellcheck must be installed and on PATH')
     if not args.no_fix and not _verify_git_available():
         raise GitNotFound(
@@ -293,7 +465,7 @@ def main() -> int:
     if not os.path.exists(args.gitlab_ci_yaml):
         print(f'file path {args.gitlab_ci_yaml!r} does not exist.')
         return 1
-    res = _main(filepath=args.gitlab_ci_yaml, no_fix=args.no_fix)
+    res = _main(filepath=args.gitlab_ci_yaml, no_fix=args.no_fix, shellcheck_bin=shellcheck_bin)
     return res
 
 
@@ -1,14 +1,18 @@
 import json
 import os
 import pathlib
+import pickle
 import subprocess
 import sys
 from typing import Any
+from typing import Iterator
+from typing import List
 from typing import TypedDict
 from typing import Union
 from unittest import mock
 
 import pytest
+import yaml
 
 
 TESTS_DIR = pathlib.Path(__file__).parent
@@ -16,7 +20,20 @@ ROOT = TESTS_DIR.parent
 EXAMPLES_DIR = pathlib.Path(__file__).parent / 'shellcheck_examples'
 sys.path.insert(0, str(ROOT))
 
-from gitlab_ci_shellcheck import shellcheck_string, job_config_to_shell, load_yaml, yaml_to_jobs, _cli
+from gitlab_ci_shellcheck import (
+    shellcheck_string,
+    shellcheck_files,
+    job_config_to_shell,
+    load_yaml,
+    yaml_to_jobs,
+    script_block_to_str,
+    ReferenceTag,
+    find_shellcheckrc,
+    _main,
+    Loader,
+    Dumper,
+    _cli,
+)
 
 
 class ExpectedShellcheckResult(TypedDict):
@@ -25,18 +42,23 @@ class ExpectedShellcheckResult(TypedDict):
     stdout_json: Union[dict, list, str]
 
 
-examples_scripts = [str(EXAMPLES_DIR / fname) for fname in os.listdir(EXAMPLES_DIR) if fname.endswith('.sh')]
-example_yamls = [str(EXAMPLES_DIR / fname) for fname in os.listdir(EXAMPLES_DIR) if fname.endswith('.yaml')]
+examples_scripts: List[pathlib.Path] = []
+example_yamls: List[pathlib.Path] = []
+with os.scandir(EXAMPLES_DIR) as entries:
+    for entry in entries:
+        if entry.name.endswith('.sh'):
+            examples_scripts.append(EXAMPLES_DIR / entry.name)
+        elif entry.name.endswith('.yaml'):
+            example_yamls.append(EXAMPLES_DIR / entry.name)
 
 
-@pytest.mark.parametrize(argnames='test_file', argvalues=examples_scripts)
-def test_shellcheck_from_string(test_file: str):
-    assert str(test_file).endswith('.sh')
-    test_file = EXAMPLES_DIR / test_file
-    expected_file = test_file.parent / str(test_file).replace('.sh', '-expected.json')
-    with open(test_file) as f:
+@pytest.mark.parametrize(argnames='test_file', argvalues=examples_scripts, ids=lambda path: path.name)
+def test_shellcheck_from_string(test_file: pathlib.Path):
+    assert test_file.suffix == '.sh'
+    expected_file = test_file.with_name(f'{test_file.stem}-expected.json')
+    with open(os.fspath(test_file)) as f:
         script = f.read()
-    with open(expected_file) as f:
+    with open(os.fspath(expected_file)) as f:
         expected: ExpectedShellcheckResult
         expected = json.loads(f.read())
 
@@ -46,27 +68,177 @@ def test_shellcheck_from_string(test_file: str):
     assert result.stderr == expected['stderr']
 
 
-@pytest.mark.parametrize(argnames='test_file', argvalues=example_yamls)
-def test_yaml_to_script(test_file: str):
-    assert str(test_file).endswith('.yaml')
-    test_file = EXAMPLES_DIR / test_file
-    expected_file = test_file.parent / str(test_file).replace('.yaml', '.sh')
-    config = load_yaml(test_file)
+@pytest.fixture(params=['orjson', 'json'])
+def json_decoder(request: pytest.FixtureRequest) -> Iterator[str]:
+    if request.param == 'orjson':
+        pytest.importorskip('orjson')
+        yield request.param
+    else:
+        with mock.patch('gitlab_ci_shellcheck.orjson', None):
+            yield request.param
+
+
+@pytest.mark.parametrize(argnames='max_workers', argvalues=[1, 2])
+def test_shellcheck_files_groups_by_file(max_workers: int, json_decoder: str):
+    script_paths = [os.fspath(test_file) for test_file in examples_scripts]
+    diagnostics = shellcheck_files(script_paths, shellcheck_args=['-f', 'json', '-s', 'bash'], max_workers=max_workers)
+    assert sorted(diagnostics) == sorted(script_paths)
+    for test_file, script_path in zip(examples_scripts, script_paths):
+        expected_file = test_file.with_name(f'{test_file.stem}-expected.json')
+        with open(os.fspath(expected_file)) as f:
+            expected: ExpectedShellcheckResult
+            expected = json.loads(f.read())
+        expected_diagnostics = [{**comment, 'file': script_path} for comment in expected['stdout_json']]
+        assert diagnostics[script_path] == expected_diagnostics
+
+
+@pytest.mark.parametrize(argnames='test_file', argvalues=example_yamls, ids=lambda path: path.name)
+def test_yaml_to_script(test_file: pathlib.Path):
+    assert test_file.suffix == '.yaml'
+    expected_file = test_file.with_suffix('.sh')
+    config = load_yaml(os.fspath(test_file))
     (job,) = yaml_to_jobs(config)
     script, after_script = job_config_to_shell(job)
-    with open(expected_file) as f:
+    with open(os.fspath(expected_file)) as f:
         expected = f.read().strip()
     assert script == expected
 
     if after_script:
-        expected_after_file = test_file.parent / str(test_file).replace('.yaml', '-after.sh')
-        if not os.path.exists(expected_after_file):
+        expected_after_file = test_file.with_name(f'{test_file.stem}-after.sh')
+        if not expected_after_file.exists():
             raise Exception('Missing expected shell file for after script')
-        with open(expected_after_file) as after_f:
+        with open(os.fspath(expected_after_file)) as after_f:
             expected_after = after_f.read()
         assert after_script == expected_after
 
 
+def test_load_yaml_jobs_only(tmp_path: pathlib.Path):
+    ci_file = tmp_path / '.gitlab-ci.yml'
+    ci_file.write_text(
+        '\n'.join(
+            [
+                'variables:',
+                '  script: &common',
+                '    - echo "shared"',
+                'stages: [test]',
+                'myjob:',
+                '  script: *common',
+            ]
+        )
+    )
+    config = load_yaml(ci_file, jobs_only=True)
+    assert config == {'myjob': {'script': ['echo "shared"']}}
+    assert yaml_to_jobs(load_yaml(ci_file)) == yaml_to_jobs(config)
+
+
+@pytest.mark.parametrize(
+    argnames='script_block, expected',
+    argvalues=[
+        ('echo a', 'echo a'),
+        (['echo a', 'echo b', 'echo c'], 'echo a\necho b\necho c'),
+        ([], ''),
+        (['echo a', ['b', 'c', 'd'], 'e', ['f', 'g']], 'echo a\nb\nc\nd\ne\nf\ng'),
+        (['echo a', ReferenceTag(['.setup', 'script']), 'echo b'], 'echo a\necho b'),
+        (ReferenceTag(['.setup', 'script']), ''),
+    ],
+    ids=['string', 'flat', 'empty', 'nested', 'reference-in-list', 'reference'],
+)
+def test_script_block_to_str(script_block: Any, expected: str):
+    assert script_block_to_str(script_block) == expected
+
+
+@pytest.mark.parametrize(
+    argnames='script_block',
+    argvalues=[['echo a', ['b', ['c']]], ['echo a', ['b', ReferenceTag(['.setup', 'script'])]], 123],
+    ids=['doubly-nested', 'reference-in-sublist', 'not-a-script'],
+)
+def test_script_block_to_str_invalid(script_block: Any):
+    with pytest.raises(ValueError, match='unexpected'):
+        script_block_to_str(script_block)
+
+
+def test_reference_tag_eq_hash():
+    tag = ReferenceTag(['.setup', 'script'])
+    assert tag == ReferenceTag(('.setup', 'script'))
+    assert hash(tag) == hash(ReferenceTag(['.setup', 'script']))
+    assert tag != ReferenceTag(['.setup', 'after_script'])
+    assert tag != ('.setup', 'script')
+    assert ReferenceTag(['.setup', 'script']) in {tag}
+
+
+def test_reference_tag_unpickled_from_other_process():
+    # pickle under a different hash seed so a stale cached hash would be detectable
+    code = 'import pickle, sys; from gitlab_ci_shellcheck import ReferenceTag; '
+    code += "sys.stdout.buffer.write(pickle.dumps(ReferenceTag(['.setup', 'script'])))"
+    env = {**os.environ, 'PYTHONHASHSEED': '1'}
+    pickled = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, check=True).stdout
+    tag = pickle.loads(pickled)
+    assert tag == ReferenceTag(['.setup', 'script'])
+    assert tag in {ReferenceTag(['.setup', 'script'])}
+
+
+def test_reference_tag_yaml_round_trip(tmp_path: pathlib.Path):
+    ci_file = tmp_path / '.gitlab-ci.yml'
+    ci_file.write_text('myjob:\n  script:\n    - !reference [.setup, script]\n    - echo "done"\n')
+    config = load_yaml(ci_file)
+    assert config == {'myjob': {'script': [ReferenceTag(['.setup', 'script']), 'echo "done"']}}
+
+    for dumper in (Dumper, yaml.Dumper):
+        dumped = yaml.dump(config, Dumper=dumper)
+        assert '!reference [.setup, script]' in dumped
+        assert yaml.load(dumped, Loader=Loader) == config
+
+
+def test_import_without_libyaml():
+    # simulate a pyyaml build without the libyaml extension
+    code = '\n'.join(
+        [
+            'import sys',
+            "sys.modules['_yaml'] = sys.modules['yaml._yaml'] = None",
+            'import yaml',
+            'import gitlab_ci_shellcheck',
+            'assert gitlab_ci_shellcheck.Loader is yaml.SafeLoader',
+            'assert gitlab_ci_shellcheck.Dumper is yaml.SafeDumper',
+            "config = yaml.load('a: !reference [.setup, script]', Loader=gitlab_ci_shellcheck.Loader)",
+            "assert yaml.dump(config, Dumper=gitlab_ci_shellcheck.Dumper) == 'a: !reference [.setup, script]\\n'",
+        ]
+    )
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+
+
+def test_find_shellcheckrc(tmp_path: pathlib.Path):
+    subdir = tmp_path / 'sub' / 'dir'
+    subdir.mkdir(parents=True)
+    rcfile = tmp_path / '.shellcheckrc'
+    rcfile.write_text('disable=SC2086\n')
+    assert find_shellcheckrc(subdir) == rcfile.resolve()
+    (subdir / 'shellcheckrc').write_text('disable=SC2034\n')
+    assert find_shellcheckrc(subdir) == (subdir / 'shellcheckrc').resolve()
+
+
+@pytest.mark.parametrize(argnames='rcfile_dir', argvalues=['.', 'sub'])
+def test_main_uses_project_shellcheckrc(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch, rcfile_dir: str):
+    project_dir = tmp_path / 'project'
+    (project_dir / 'sub').mkdir(parents=True)
+    ci_file = project_dir / '.gitlab-ci.yml'
+    ci_file.write_text('myjob:\n  script:\n    - echo $FOO\n')
+    monkeypatch.chdir(project_dir / rcfile_dir)
+    assert _main(os.fspath(ci_file)) == 1
+
+    (project_dir / '.shellcheckrc').write_text('disable=SC2086\n')
+    assert _main(os.fspath(ci_file)) == 0
+
+
+def test_main_reports_shellcheck_failure(tmp_path: pathlib.Path, capsys: pytest.CaptureFixture[str]):
+    fake_shellcheck = tmp_path / 'shellcheck'
+    fake_shellcheck.write_text('#!/bin/sh\necho "something went wrong" >&2\nexit 3\n')
+    fake_shellcheck.chmod(0o755)
+    assert _main(os.fspath(EXAMPLES_DIR / 'before-script.yaml'), shellcheck_bin=os.fspath(fake_shellcheck)) == 1
+    out = capsys.readouterr().out
+    assert 'shellcheck failed with exit status 3' in out
+    assert 'something went wrong' in out
+
+
 def test_cli_fail():
     testargs = ['gitlab-ci-shellcheck', 'tests/shellcheck_examples/simple-test.yaml']
     with mock.patch.object(sys, 'argv', testargs):